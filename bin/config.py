@@ -17,10 +17,9 @@ limitations under the License.
 
 import sys
 import os
+import stat
 import argparse
 import logging
-from configparser import ConfigParser
-import http.client as http_client
 
 # 2022, new name for ETP is SIA
 product_name = "Secure Internet Access Enterprise"
@@ -30,101 +29,156 @@ epilog = '''Copyright (C) Akamai Technologies, Inc\n''' \
 logger = logging.getLogger(__name__)
 
 
-class EdgeGridConfig():
+def _add_parser(subparsers, name, help_text):
+    """Add a command subparser, with the CLI epilog and raw text help formatting."""
+    return subparsers.add_parser(name, help=help_text, epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
+
+
+def _build_event_parser(subparsers):
+    """Security events command."""
+    event_parser = _add_parser(subparsers, "event", "Fetch last events (from 30 min ago to 3 min ago)")
+    event_parser.add_argument('event_type', nargs='?', default="threat",
+                              choices=['threat', 'aup', 'dns', 'proxy', 'netcon'],
+                              help="Event type: Threat, Acceptable User "
+                                   "Policy (AUP), DNS, Proxy or "
+                                   "Network traffic connections details")
+    event_parser.add_argument('--start', '-s', type=int, help="Start datetime (EPOCH),\nDefault is 30 min ago")
+    event_parser.add_argument('--end', '-e', type=int, help="End datetime (EPOCH),\nDefault is now - 3 min")
+    event_parser.add_argument('--output', '-o', help="Output file, default is stdout. Encoding is utf-8.")
+    event_parser.add_argument('--tail', '-f', action='store_true', default=False,
+                              help="""Do not stop when most recent log is reached,\n"""
+                                   """rather to wait for additional data to be appended\n"""
+                                   """to the input. --start and --end are ignored when used.""")
+    event_parser.add_argument('--poll', type=int, default=60,
+                              help="Poll frequency in seconds with --tail mode. Default is 60s")
+    event_parser.add_argument('--limit', type=int, default=os.environ.get("CLIETP_FETCH_LIMIT", 3*60),
+                              help="Stop the most recent fetch to now minus specified seconds, default is 3 min. "
+                                   "Applicable to --tail. Environment variable: CLIETP_FETCH_LIMIT")
+    event_parser.add_argument('--concurrent', type=int, default=os.environ.get('CLIETP_FETCH_CONCURRENT', 1),
+                              help="Number of concurrent API calls. Environment variable: CLIETP_FETCH_CONCURRENT")
+
+
+def _build_list_parser(subparsers):
+    """ETP security lists command."""
+    list_parser = _add_parser(subparsers, "list", "Manage ETP security list")
+    subsub = list_parser.add_subparsers(dest="list_action", help='List action')
+
+    listcreate = subsub.add_parser("create", help="Create a new security list")
+    listcreate.add_argument('name', type=str, help='List name')
+    listcreate.add_argument('description', type=str, help='List description')
+    # TODO: offer choice based on ETPListCategory enum
+    listcreate.add_argument('category', type=int, default=4, help='List category ID')
+
+    listdelete = subsub.add_parser("delete", help="Delete a security list")
+    listdelete.add_argument('listid', type=int, help='List ID')
+
+    listget = subsub.add_parser("get", help="List of ETP security lists")
+    listget.add_argument('listid', type=int, nargs='?', metavar='listid', help='ETP list ID')
+
+    listadd = _add_parser(subsub, "add_item", "Add one or multiple IP or host to a list")
+    listadd.add_argument('listid', type=int, metavar='listid', help='ETP list ID')
+    listadd.add_argument('iporhost', metavar='IP/host', nargs='+', help='IP or FQDN to add/remove to the list')
+    listadd.add_argument('--suspect', dest='suspect', default=False, action="store_true",
+                         help='Item will be added as suspect confidence instead of known')
+
+    listremove = _add_parser(subsub, "remove_item", "Remove one or multiple IP or host from a list")
+    listremove.add_argument('listid', type=int, metavar='listid', help='ETP list ID')
+    listremove.add_argument('iporhost', metavar='IP/host', nargs='+', help='IP or FQDN to add/remove to the list')
+
+    listdeploy = _add_parser(subsub, "deploy", "Deploy changes made to a list")
+    listdeploy.add_argument('listid', type=int, metavar='listid', help='ETP list ID')
+
+
+def _build_ioc_parser(subparsers):
+    """Indicator of Compromise (IOC) command."""
+    ioc_parser = _add_parser(subparsers, "ioc", "Manage Indicator of Compromise (IOC) feed intelligence")
+    iocsubsub = ioc_parser.add_subparsers(dest="ioc_action", help='List action')
+    ioc_info = iocsubsub.add_parser("info", help="Information on a particular internet domain")
+    ioc_info.add_argument('domain', type=str, metavar='domain', help='Internet domain (eg. example.com)')
+    ioc_timeseries = iocsubsub.add_parser("timeseries", help="Time Series intelligence")
+    ioc_timeseries.add_argument('domain', type=str, metavar='domain', help='Internet domain (eg. example.com)')
+    ioc_changes = iocsubsub.add_parser("changes", help="Information on a particular internet domain")
+    ioc_changes.add_argument('domain', type=str, metavar='domain', help='Internet domain (eg. example.com)')
+
+
+def _build_tenant_parser(subparsers):
+    """Sub-tenants command."""
+    tenant_parser = _add_parser(subparsers, "tenant", "Manage ETP Account sub-tenants")
+    tenant_operation = tenant_parser.add_subparsers(dest="operation", help='Sub-tenant operation')
+    _add_parser(tenant_operation, "list", "List all tenants in the account")
+    tenant_reportclient = _add_parser(tenant_operation, "clients", "Active ETP Client for the last 30 days per tenant")
+    tenant_reportclient.add_argument('--start', '-s', type=int, help="Start datetime (EPOCH),\nDefault is 1h ago")
+    tenant_reportclient.add_argument('--end', '-e', type=int, help="End datetime (EPOCH),\nDefault is now")
+
+
+#: Build a command subparser, indexed per command name
+_SUBPARSER_BUILDERS = {
+    "event": _build_event_parser,
+    "list": _build_list_parser,
+    "ioc": _build_ioc_parser,
+    "tenant": _build_tenant_parser,
+}
+
+
+def _sniff_command(parser, argv):
+    """
+    Return the command (first positional argument) in argv, skipping the options of parser and their value.
+    Abbreviated long options (--sec) and combined short flags (-vc) are resolved like argparse does.
+    None is returned if no command is found, if the help is requested or if an option is unknown or ambiguous.
+    """
+    # argparse doesn't expose its actions publicly
+    with_value, without_value = set(), set()
+    for action in parser._actions:
+        (without_value if action.nargs == 0 else with_value).update(action.option_strings)
+    long_options = [option for option in with_value | without_value if option.startswith('--')]
+
+    skip_value = False
+    for token in argv:
+        if skip_value:
+            skip_value = False
+        elif token.startswith('--'):
+            if token == '--':
+                return None
+            name, equal, _ = token.partition('=')
+            matches = [option for option in long_options if option.startswith(name)]
+            option = name if name in long_options else matches[0] if len(matches) == 1 else None
+            if option is None or option == '--help':
+                return None
+            skip_value = option in with_value and not equal
+        elif token.startswith('-') and len(token) > 1:
+            for i, flag in enumerate(token[1:], 2):
+                option = '-' + flag
+                if option == '-h' or option not in with_value | without_value:
+                    return None
+                if option in with_value:
+                    # The value is either the rest of the token or the next token
+                    skip_value = i == len(token)
+                    break
+        else:
+            return token
+    return None
+
+
+def _load_edgerc(path, section):
+    """Return the key/value pairs of a section of the credentials file, None if the section doesn't exist."""
+    from configparser import ConfigParser
+    config = ConfigParser()
+    with open(path, encoding='utf-8') as f:
+        config.read_file(f)
+    if not config.has_section(section):
+        return None
+    return dict(config.items(section))
 
-    parser = argparse.ArgumentParser(prog="akamai etp",
-                                     description='Interact with ETP configuration and logs/events',
-                                     epilog=epilog,
-                                     formatter_class=argparse.RawTextHelpFormatter)
 
-    def __init__(self, config_values, configuration, flags=None):
-        parser = self.parser
-        subparsers = parser.add_subparsers(dest="command", help='ETP object to manipulate')
-
-        # Security Events
-        event_parser = subparsers.add_parser("event", help="Fetch last events (from 30 min ago to 3 min ago)",
-                                             epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
-        event_parser.add_argument('event_type', nargs='?', default="threat",
-                                  choices=['threat', 'aup', 'dns', 'proxy', 'netcon'],
-                                  help="Event type: Threat, Acceptable User "
-                                       "Policy (AUP), DNS, Proxy or "
-                                       "Network traffic connections details")
-        event_parser.add_argument('--start', '-s', type=int, help="Start datetime (EPOCH),\nDefault is 30 min ago")
-        event_parser.add_argument('--end', '-e', type=int, help="End datetime (EPOCH),\nDefault is now - 3 min")
-        event_parser.add_argument('--output', '-o', help="Output file, default is stdout. Encoding is utf-8.")
-        event_parser.add_argument('--tail', '-f', action='store_true', default=False,
-                                  help="""Do not stop when most recent log is reached,\n"""
-                                       """rather to wait for additional data to be appended\n"""
-                                       """to the input. --start and --end are ignored when used.""")
-        event_parser.add_argument('--poll', type=int, default=60,
-                                  help="Poll frequency in seconds with --tail mode. Default is 60s")
-        event_parser.add_argument('--limit', type=int, default=os.environ.get("CLIETP_FETCH_LIMIT", 3*60),
-                                  help="Stop the most recent fetch to now minus specified seconds, default is 3 min. "
-                                       "Applicable to --tail. Environment variable: CLIETP_FETCH_LIMIT")
-        event_parser.add_argument('--concurrent', type=int, default=os.environ.get('CLIETP_FETCH_CONCURRENT', 1),
-                                  help="Number of concurrent API calls. Environment variable: CLIETP_FETCH_CONCURRENT")
-
-        # ETP Lists
-        list_parser = subparsers.add_parser("list", help="Manage ETP security list",
-                                            epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
-        subsub = list_parser.add_subparsers(dest="list_action", help='List action')
-
-        listcreate = subsub.add_parser("create", help="Create a new security list")
-        listcreate.add_argument('name', type=str, help='List name')
-        listcreate.add_argument('description', type=str, help='List description')
-        # TODO: offer choice based on ETPListCategory enum
-        listcreate.add_argument('category', type=int, default=4, help='List category ID')
-
-        listdelete = subsub.add_parser("delete", help="Delete a security list")
-        listdelete.add_argument('listid', type=int, help='List ID')
-
-        listget = subsub.add_parser("get", help="List of ETP security lists")
-        listget.add_argument('listid', type=int, nargs='?', metavar='listid', help='ETP list ID')
-
-        listadd = subsub.add_parser("add_item", help="Add one or multiple IP or host to a list",
-                                    epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
-        listadd.add_argument('listid', type=int, metavar='listid', help='ETP list ID')
-        listadd.add_argument('iporhost', metavar='IP/host', nargs='+', help='IP or FQDN to add/remove to the list')
-        listadd.add_argument('--suspect', dest='suspect', default=False, action="store_true",
-                             help='Item will be added as suspect confidence instead of known')
-
-        listremove = subsub.add_parser("remove_item", help="Remove one or multiple IP or host from a list",
-                                       epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
-        listremove.add_argument('listid', type=int, metavar='listid', help='ETP list ID')
-        listremove.add_argument('iporhost', metavar='IP/host', nargs='+', help='IP or FQDN to add/remove to the list')
-
-        listdeploy = subsub.add_parser("deploy", help="Deploy changes made to a list",
-                                       epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
-        listdeploy.add_argument('listid', type=int, metavar='listid', help='ETP list ID')
-
-        # IOC
-        ioc_parser = subparsers.add_parser("ioc", help="Manage Indicator of Compromise (IOC) feed intelligence",
-                                           epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
-        iocsubsub = ioc_parser.add_subparsers(dest="ioc_action", help='List action')
-        ioc_info = iocsubsub.add_parser("info", help="Information on a particular internet domain")
-        ioc_info.add_argument('domain', type=str, metavar='domain', help='Internet domain (eg. example.com)')
-        ioc_timeseries = iocsubsub.add_parser("timeseries", help="Time Series intelligence")
-        ioc_timeseries.add_argument('domain', type=str, metavar='domain', help='Internet domain (eg. example.com)')
-        ioc_changes = iocsubsub.add_parser("changes", help="Information on a particular internet domain")
-        ioc_changes.add_argument('domain', type=str, metavar='domain', help='Internet domain (eg. example.com)')
-
-        # Sub-tenants
-        tenant_parser = subparsers.add_parser("tenant", help="Manage ETP Account sub-tenants",
-                                              epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
-        tenant_operation = tenant_parser.add_subparsers(dest="operation", help='Sub-tenant operation')
-        tenant_operation.add_parser(
-            "list", help="List all tenants in the account",
-            epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
-        tenant_reportclient = tenant_operation.add_parser(
-            "clients", help="Active ETP Client for the last 30 days per tenant",
-            epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
-        tenant_reportclient.add_argument('--start', '-s', type=int, help="Start datetime (EPOCH),\nDefault is 1h ago")
-        tenant_reportclient.add_argument('--end', '-e', type=int, help="End datetime (EPOCH),\nDefault is now")
+class EdgeGridConfig():
 
+    def __init__(self, config_values, configuration, flags=None):
+        # Each instance gets its own parser, subparsers can be added only once
+        parser = self.parser = argparse.ArgumentParser(prog="akamai etp",
+                                                       description='Interact with ETP configuration and logs/events',
+                                                       epilog=epilog,
+                                                       formatter_class=argparse.RawTextHelpFormatter)
         # General options
-        subparsers.add_parser("version", help="Display CLI ETP module version",
-                              epilog=epilog, formatter_class=argparse.RawTextHelpFormatter)
-
         parser.add_argument('--verbose', '-v', default=False, action='count', help=' Verbose mode')
         parser.add_argument('--debug', '-d', default=False, action='count', help=' Debug mode (prints HTTP headers)')
         parser.add_argument('--logfile', '-l', default=None, help='Log file, stdout if not set')
@@ -141,13 +195,25 @@ class EdgeGridConfig():
             for argument in flags.keys():
                 parser.add_argument('--' + argument, action=flags[argument])
 
-        arguments = {}
-        for argument in config_values:
-            if config_values[argument]:
-                if config_values[argument] == "False" or config_values[argument] == "True":
-                    parser.add_argument('--' + argument, action='count')
+        # Each config value is registered once, as a counter for boolean values
+        for argument, value in config_values.items():
+            if not value:
+                continue
+            if isinstance(value, bool) or value in ("True", "False"):
+                parser.add_argument('--' + argument, action='count')
+            else:
                 parser.add_argument('--' + argument)
-                arguments[argument] = config_values[argument]
+
+        subparsers = parser.add_subparsers(dest="command", help='ETP object to manipulate')
+
+        # Only build the subparser matching the command, all of them if unknown or help is requested
+        command = _sniff_command(parser, sys.argv[1:])
+        if command in _SUBPARSER_BUILDERS:
+            _SUBPARSER_BUILDERS[command](subparsers)
+        else:
+            for build_subparser in _SUBPARSER_BUILDERS.values():
+                build_subparser(subparsers)
+        _add_parser(subparsers, "version", "Display CLI ETP module version")
 
         try:
             args = parser.parse_args()
@@ -157,6 +223,7 @@ class EdgeGridConfig():
         arguments = vars(args)
 
         if arguments['debug']:
+            import http.client as http_client
             http_client.HTTPConnection.debuglevel = 1
             logging.basicConfig()
             logging.getLogger().setLevel(logging.DEBUG)
@@ -169,16 +236,20 @@ class EdgeGridConfig():
 
         arguments["edgerc"] = os.path.expanduser(arguments["edgerc"])
 
-        if os.path.isfile(arguments["edgerc"]):
-            config = ConfigParser()
-            config.read_file(open(arguments["edgerc"]))
-            if not config.has_section(configuration):
+        try:
+            edgerc_stat = os.stat(arguments["edgerc"])
+        except OSError:
+            edgerc_stat = None
+
+        if edgerc_stat and stat.S_ISREG(edgerc_stat.st_mode):
+            edgerc_values = _load_edgerc(arguments["edgerc"], configuration)
+            if edgerc_values is None:
                 err_msg = "ERROR: No section named %s was found in your %s file\n" % \
                            (configuration, arguments["edgerc"])
                 err_msg += "ERROR: Please generate credentials for the script functionality\n"
                 err_msg += "ERROR: and run 'python gen_edgerc.py %s' to generate the credential file\n" % configuration
                 sys.exit(err_msg)
-            for key, value in config.items(configuration):
+            for key, value in edgerc_values.items():
                 # ConfigParser lowercases magically
                 if key not in arguments or arguments[key] is None:
                     arguments[key] = value
@@ -187,11 +258,11 @@ class EdgeGridConfig():
                           "set up once you've provisioned credentials in LUNA.")
                     return None
 
-        for option in arguments:
-            setattr(self, option, arguments[option])
+        self.__dict__.update(arguments)
 
         self.create_base_url()
 
     def create_base_url(self):
-        if hasattr(self, 'host'):
-            self.base_url = "https://%s" % self.host
+        host = getattr(self, 'host', None)
+        if host:
+            self.base_url = f"https://{host}"
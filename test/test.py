@@ -20,77 +20,153 @@ Tested with nose2:
 
 # Optional
 EDGERC_SECTION=mysection
+# Maximum duration of a list add/remove of 100 items, in seconds
+ETP_TEST_LIST_OP_MAX_SEC=10
+# Create a security list per test instead of one shared by all the TestListETP tests
+ETP_TEST_LIST_PER_TEST=1
 # End Optional
 
 cd test
 nose2 -v
+# Or with tests running in parallel, in 8 processes
+nose2 -v --plugin nose2.plugins.mp -N 8
 open report.html
 ```
 """
 
 import unittest
 import subprocess
-import shlex
+import sys
+import io
+import contextlib
+import runpy
+import functools
+import logging
 import time
 from pathlib import Path
-import collections
 import tempfile
 import os
-import random
 import re
 import json
 
 
 # Global variables
 encoding = 'utf-8'
+version_regex = re.compile(r'\d+\.\d+\.\d+\n')
+listid_regex = re.compile(r" (\d+) ")
+#: Regression guard on list operations duration, includes the network/API latency (and the interpreter startup)
+list_op_max_sec = float(os.environ.get('ETP_TEST_LIST_OP_MAX_SEC', 10))
+
+
+@functools.lru_cache(maxsize=None)
+def cli_prefix(maindir, section):
+    """Beginning of the CLI command line: interpreter, CLI script and optional credentials section."""
+    prefix = (sys.executable, os.path.join(maindir, 'bin', 'akamai-etp'))
+    if section:
+        prefix += ("--section", section)
+    return prefix
+
+
+def cli_run_inprocess(command):
+    """
+    Run the CLI command within the test process, for commands stopping before any API call (e.g. the help).
+    Returns the return code and the stdout of the CLI, stderr is discarded.
+    The process state changed by the CLI (sys.argv, sys.path, config module, root logger) is restored.
+    """
+    script = command[1]
+    stdout = io.StringIO()
+    root_logger = logging.getLogger()
+    saved_handlers, saved_level = root_logger.handlers[:], root_logger.level
+    saved_argv, saved_path = sys.argv, sys.path[:]
+    # The CLI imports its own config module, which may not be the one already imported
+    saved_config = sys.modules.pop('config', None)
+    sys.argv = command[1:]
+    sys.path.insert(0, os.path.dirname(script))
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+            runpy.run_path(script, run_name='__main__')
+        returncode = 0
+    except SystemExit as e:
+        # Same return code as the interpreter exiting with e
+        returncode = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+    finally:
+        sys.argv = saved_argv
+        sys.path[:] = saved_path
+        sys.modules.pop('config', None)
+        if saved_config is not None:
+            sys.modules['config'] = saved_config
+        for handler in root_logger.handlers[:]:
+            root_logger.removeHandler(handler)
+        for handler in saved_handlers:
+            root_logger.addHandler(handler)
+        root_logger.setLevel(saved_level)
+    return returncode, stdout.getvalue()
 
 
 class CliETPTest(unittest.TestCase):
     seed = 0
-    testdir = None
-    maindir = None
+    testdir = Path(__file__).resolve().parent
+    maindir = testdir.parent
 
     def setUp(self):
-        self.testdir = Path(__file__).resolve().parent
-        self.maindir = Path(__file__).resolve().parent.parent
-        self.seed = random.randint(10000, 99999)
-
-    def cli_command(self, *args):
-        command = shlex.split(f'python3 {self.maindir}/bin/akamai-etp')
-        if os.environ.get('EDGERC_SECTION'):
-            command.extend(["--section", os.environ['EDGERC_SECTION']])
+        self.seed = CliETPTest.new_seed()
+
+    @staticmethod
+    def new_seed():
+        return 10000 + int.from_bytes(os.urandom(3), 'little') % 90000
+
+    @classmethod
+    def cli_command(cls, *args):
+        section = os.environ.get('EDGERC_SECTION')
+        command = list(cli_prefix(str(cls.maindir), section))
         command.extend(*args)
 
-        print(f"\nEDGERC_SECTION={os.environ.get('EDGERC_SECTION', 'default')}")
+        print(f"\nEDGERC_SECTION={section or 'default'}")
         print("\nCOMMAND: ", " ".join(command))
         return command
 
-    def cli_run(self, *args):
-        cmd = subprocess.Popen(self.cli_command(str(a) for a in args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return cmd
-
-    def line_count(filename):
-        count = 0
-        with open(filename) as f:
-            while next(f, False):
-                count += 1
-        return count
+    @classmethod
+    def cli_run(cls, *args, capture_stderr=False, text=True):
+        """
+        Run the CLI with args, output is decoded as str unless text is False.
+        """
+        command = cls.cli_command(str(a) for a in args)
+        return subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE if capture_stderr else subprocess.DEVNULL,
+                                encoding=encoding if text else None, errors='replace' if text else None)
 
-    def duplicate_count(filename):
-        total_count = 0
-        with open(filename) as infile:
-            counts = collections.Counter(line.strip() for line in infile)
-        for line, count in counts.most_common():
-            if count > 1:
-                print(f"DUPLICATE[{count}] {line}")
-                total_count += 1
-        return total_count
+    @staticmethod
+    def scan_file(filename):
+        """
+        Count the lines and the duplicated lines of a file, in a single pass.
+        Returns a (line_count, duplicate_count) tuple.
+        """
+        line_count = 0
+        seen = set()
+        duplicates = {}
+        with open(filename, 'rb', buffering=1 << 20) as infile:
+            for line in infile:
+                line_count += 1
+                line = line.rstrip()
+                if line in seen:
+                    duplicates[line] = duplicates.get(line, 1) + 1
+                else:
+                    seen.add(line)
+        for line, count in duplicates.items():
+            print(f"DUPLICATE[{count}] {line.decode(encoding, errors='replace')}")
+        return line_count, len(duplicates)
 
 
 class BaseTestEvents(CliETPTest):
 
-    after = int(time.time() - 30 * 60)
-    before = int(time.time())
+    after = None
+    before = None
+
+    def setUp(self):
+        super().setUp()
+        # Time window computed per test, tests may run in parallel and at different times
+        self.before = int(time.time())
+        self.after = self.before - 30 * 60
 
     @staticmethod
     def is_sorted(l):
@@ -110,13 +186,12 @@ class BaseTestEvents(CliETPTest):
         """
         Fetch threat events
         """
-        cmd = self.cli_run("event", "threat", "--start", self.after, "--end", self.before)
+        cmd = self.cli_run("event", "threat", "--start", self.after, "--end", self.before, capture_stderr=True)
         stdout, stderr = cmd.communicate(timeout=360)
-        events = stdout.decode(encoding)
-        events_list = events.splitlines()
+        events_list = stdout.splitlines()
 
         if cmd.returncode != 0:
-            print(stderr.decode(encoding))
+            print(stderr)
 
         self.assertEqual(cmd.returncode, 0, f'cli-etp return code must be 0, {cmd.returncode} returned')
         self.assertGreater(len(events_list), 0, "We expect at least one threat event")
@@ -129,8 +204,7 @@ class BaseTestEvents(CliETPTest):
         """
         cmd = self.cli_run("event", "aup", "--start", self.after, "--end", self.before)
         stdout, stderr = cmd.communicate(timeout=120)
-        events = stdout.decode(encoding)
-        events_list = events.splitlines()
+        events_list = stdout.splitlines()
         event_count = len(events_list)
         self.assertEqual(cmd.returncode, 0, 'return code must be 0')
         self.assertGreater(event_count, 0, "We expect at least one AUP event")
@@ -159,14 +233,13 @@ class BaseTestEvents(CliETPTest):
         """
         Fetch DNS events (the most chatty one)
         """
-        cmd = self.cli_run("event", "dns", "--start", self.after, "--end", self.before)
+        cmd = self.cli_run("event", "dns", "--start", self.after, "--end", self.before, capture_stderr=True)
         stdout, stderr = cmd.communicate(timeout=360)
-        events = stdout.decode(encoding)
-        events_list = events.splitlines()
+        events_list = stdout.splitlines()
         print(f"Loaded {len(events_list)} security events (DNS).")
 
         if cmd.returncode != 0:
-            print(stderr.decode(encoding))
+            print(stderr)
 
         self.assertEqual(cmd.returncode, 0, f'cli-etp return code must be 0, {cmd.returncode} returned')
         self.assertGreater(len(events_list), 0, "We expect at least one threat event")
@@ -178,29 +251,28 @@ class BaseTestEvents(CliETPTest):
         Fetch AUP events, export as a file
         """
         output_handle, output_filename = tempfile.mkstemp()
+        os.close(output_handle)  # The CLI opens the file by its name
         try:
             cmd = self.cli_run("event", "aup", "--start", self.after, "--end", self.before, '--output', output_filename)
             stdout, stderr = cmd.communicate(timeout=120)
             self.assertEqual(cmd.returncode, 0, 'return code must be 0')
-            line_count = TestCliETP.line_count(output_filename)
+            line_count, duplicate_count = CliETPTest.scan_file(output_filename)
             print(f"Output contains {line_count} lines")
-            duplicate_count = CliETPTest.duplicate_count(output_filename)
             self.assertGreater(line_count, 0, "We expect at least a few events")
             print(f"We found {duplicate_count} duplicates")
             self.assertEqual(duplicate_count, 0)
 
         finally:
-            if os.path.isfile(output_filename):
+            with contextlib.suppress(FileNotFoundError):
                 os.remove(output_filename)
 
     def test_event_netcon(self):
         """
         Fetch Network Connection Details events
         """
-        cmd = self.cli_run("event", "netcon", "--start", self.after, "--end", self.before)
+        cmd = self.cli_run("event", "netcon", "--start", self.after, "--end", self.before, text=False)
         stdout, stderr = cmd.communicate(timeout=120)
-        events = stdout.decode(encoding)
-        event_count = len(events.splitlines())
+        event_count = stdout.count(b'\n')
         self.assertGreater(event_count, 0, "We expect at least one Network Connections Details event")
         self.assertEqual(cmd.returncode, 0, 'return code must be 0')
 
@@ -208,7 +280,7 @@ class BaseTestEvents(CliETPTest):
 class TestEvents(BaseTestEvents):
     def setUp(self):
         super().setUp()
-        del os.environ['CLIETP_FETCH_CONCURRENT']
+        os.environ.pop('CLIETP_FETCH_CONCURRENT', None)
 
 
 class TestEventsMaxThread(BaseTestEvents):
@@ -222,12 +294,23 @@ class TestCliETP(CliETPTest):
     def test_no_edgerc(self):
         """
         Call CLI with a bogus edgerc file, help should be displayed.
+        The CLI stops at the argparse help, before any API call, so it runs within the test process.
+        Every other test runs the CLI in a child process.
         """
-        cmd = self.cli_run('-e', 'file_not_exist')
-        stdout, stderr = cmd.communicate()
-        output = stdout.decode(encoding)
-        self.assertIn("usage: akamai etp", output)
-        self.assertEqual(cmd.returncode, 0, 'return code must be 0')
+        returncode, stdout = cli_run_inprocess(self.cli_command(('-e', 'file_not_exist')))
+        self.assertIn("usage: akamai etp", stdout)
+        self.assertEqual(returncode, 0, 'return code must be 0')
+
+    def test_section_named_as_command(self):
+        """
+        A credentials section named after a command, with abbreviated or combined options, is not the command.
+        No API call involved.
+        """
+        for options in (('--sec', 'event'), ('-vc', 'event')):
+            cmd = self.cli_run('-e', 'file_not_exist', *options, 'list', '-h')
+            stdout, stderr = cmd.communicate()
+            self.assertIn("usage: akamai etp list", stdout)
+            self.assertEqual(cmd.returncode, 0, 'return code must be 0')
 
     def test_cli_version(self):
         """
@@ -235,67 +318,104 @@ class TestCliETP(CliETPTest):
         """
         cmd = self.cli_run('version')
         stdout, stderr = cmd.communicate()
-        self.assertRegex(stdout.decode(encoding), r'[0-9]+\.[0-9]+\.[0-9]+\n', 'Version should be x.y.z')
+        self.assertRegex(stdout, version_regex, 'Version should be x.y.z')
         self.assertEqual(cmd.returncode, 0, 'return code must be 0')
 
 
 class TestListETP(CliETPTest):
 
     listid = None
+    #: One list per test instead of one for the whole class, for isolation
+    list_per_test = bool(os.environ.get('ETP_TEST_LIST_PER_TEST'))
 
-    """
-    Create a list
-    """
-    def setUp(self):
-        super().setUp()
-        cmd = self.cli_run('list', 'create', f'clietp_list_{self.seed}', "Created by test/test.py", 4)
+    @classmethod
+    def create_list(cls):
+        """
+        Create a list and return its ID
+        """
+        cmd = cls.cli_run('list', 'create', f'clietp_list_{cls.new_seed()}', "Created by test/test.py", 4,
+                          capture_stderr=True)
         stdout, stderr = cmd.communicate()
+        # Checked first: no list is created when the command fails
         if cmd.returncode != 0:
             print(stdout, stderr)
+            raise AssertionError('return code must be 0')
+
+        matches = listid_regex.findall(stdout)
+        if len(matches) != 1:
+            raise AssertionError('A list ID must be displayed after the command akamai etp list create ...')
+        listid = int(matches[0])
+        print("ListID=", listid)
+        return listid
+
+    @classmethod
+    def delete_list(cls, listid):
+        cmd = cls.cli_run('list', 'delete', listid, capture_stderr=True)
+        stdout, stderr = cmd.communicate()
+        if cmd.returncode != 0:
+            print("ERROR cli_run:", stdout, stderr)
+            raise AssertionError('return code must be 0')
 
-        self.listid = stdout
-        regex = r" (\d+) "
-        matches = re.findall(regex, stdout.decode())
-        self.assertEqual(len(matches), 1, 'A list ID must be displayed after the command akamai etp list create ...')
-        self.listid = int(matches[0])
-        print("ListID=", self.listid)
-        self.assertEqual(cmd.returncode, 0, 'return code must be 0')
+    """
+    Create a list, shared by all the tests of the class unless ETP_TEST_LIST_PER_TEST is set
+    """
+    @classmethod
+    def setUpClass(cls):
+        if not cls.list_per_test:
+            cls.listid = cls.create_list()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.listid:
+            cls.delete_list(cls.listid)
+
+    def setUp(self):
+        super().setUp()
+        if self.list_per_test:
+            self.listid = self.create_list()
 
     def tearDown(self):
-        if self.listid:
-            cmd = self.cli_run('list', 'delete', self.listid)
-            stdout, stderr = cmd.communicate()
-            if cmd.returncode != 0:
-                print("ERROR cli_run:", stdout, stderr)
-            self.assertEqual(cmd.returncode, 0, 'return code must be 0')
+        if self.list_per_test and self.listid:
+            self.delete_list(self.listid)
 
     """
     TODO: add a create and remove list once implemented in the cli
     """
     def test_add100_list(self):
 
-        test_fqdns = list("testhost-{}-{}.cli-etp.unittest".format(i, self.seed) for i in range(100))
+        suffix = f"-{self.seed}.cli-etp.unittest"
+        test_fqdns = [f"testhost-{i}{suffix}" for i in range(100)]
 
-        cmd = self.cli_run('list', 'add_item', self.listid, *test_fqdns)
+        # All items are sent within a single API call, the duration is checked as a regression guard
+        t0 = time.monotonic()
+        cmd = self.cli_run('list', 'add_item', self.listid, *test_fqdns, capture_stderr=True)
         stdout, stderr = cmd.communicate()
+        elapsed = time.monotonic() - t0
         if cmd.returncode != 0:
             print(stdout, stderr)
         self.assertEqual(cmd.returncode, 0, 'add 100 items sub-operation: return code must be 0')
+        self.assertLess(elapsed, list_op_max_sec,
+                        f'Regression guard, not a correctness check: add 100 items sub-operation took {elapsed:.2f}s, '
+                        f'more than ETP_TEST_LIST_OP_MAX_SEC={list_op_max_sec}s')
 
-        cmd = self.cli_run('list', 'remove_item', self.listid, *test_fqdns)
+        t0 = time.monotonic()
+        cmd = self.cli_run('list', 'remove_item', self.listid, *test_fqdns, capture_stderr=True)
         stdout, stderr = cmd.communicate()
+        elapsed = time.monotonic() - t0
         if cmd.returncode != 0:
             print("ERROR with the command ", cmd.args, stdout, stderr)
         self.assertEqual(cmd.returncode, 0, 'remove 100 items sub-operation: return code must be 0')
+        self.assertLess(elapsed, list_op_max_sec,
+                        f'Regression guard, not a correctness check: remove 100 items sub-operation took '
+                        f'{elapsed:.2f}s, more than ETP_TEST_LIST_OP_MAX_SEC={list_op_max_sec}s')
 
     def test_get_lists(self):
         """
         Get the security lists configured in the tenant
         """
-        cmd = self.cli_run('list', 'get')
+        cmd = self.cli_run('list', 'get', text=False)
         stdout, stderr = cmd.communicate()
-        output = stdout.decode(encoding)
-        line_count = len(output.splitlines())
+        line_count = stdout.count(b'\n')
         print(line_count)
         self.assertGreater(line_count, 0, "We expect at least one list to be on this tenant/config_id")
         self.assertEqual(cmd.returncode, 0, 'return code must be 0')